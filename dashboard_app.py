@@ -1,9 +1,11 @@
 import os
+import json
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import streamlit as st
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 from streamlit.components.v1 import html as st_html
 
 # =========================
@@ -18,10 +20,18 @@ COD_PATH  = os.path.join(OUT_DIR, "snip_2025Q4_codede.csv")
 ENT_PATH  = os.path.join(OUT_DIR, "snip_2025Q4_entidades.csv")
 BUD_PATH  = os.path.join(OUT_DIR, "snip_2025Q4_budget_inconsistencias.csv")
 
-ESRI_WORLD_IMAGERY = (
+# SNIP_TILES_URL permite apuntar a un proxy/cache local de teselas (misma plantilla {z}/{y}/{x})
+ESRI_WORLD_IMAGERY = os.getenv("SNIP_TILES_URL", (
     "https://server.arcgisonline.com/ArcGIS/rest/services/"
     "World_Imagery/MapServer/tile/{z}/{y}/{x}"
-)
+))
+
+# Zoom mínimo a escala país: evita pedir teselas de nivel mundial/continental
+MAP_MIN_ZOOM = 6
+
+# performance cap (marcadores en el mapa): top por riesgo fiscal + muestra del resto
+MAX_MARKERS = 1500
+TOP_RISK_MARKERS = 500
 
 # Para display
 MONEY_COLS_SNIP = ["presupuesto_actual_vigente", "ejecutado_total_calc", "no_ejecutado_vigente"]
@@ -29,74 +39,86 @@ RATIO_COLS_SNIP = ["ratio_ejec_real"]
 MONEY_COLS_AGG  = ["presupuesto_vigente", "ejecutado_total", "no_ejecutado", "presupuesto_inconsistencia_estado_momento"]
 RATIO_COLS_AGG  = ["ratio_ejec_agg"]
 
-# =========================
-# Load
-# =========================
-@st.cache_data
-def load_csv(path: str) -> pd.DataFrame:
-    return pd.read_csv(path)
-
-snip = load_csv(SNIP_PATH)
-muni = load_csv(MUN_PATH)
-cod  = load_csv(COD_PATH)
-ent  = load_csv(ENT_PATH)
-bud  = load_csv(BUD_PATH)
-
-# Ensure numeric types for key columns (filters/sorting)
-for c in ["presupuesto_actual_vigente","ejecutado_total_calc","no_ejecutado_vigente","ratio_ejec_real",
-          "riesgo_fiscal","flag_inconsistencia_estado_momento","months_since_last_exec","zero_run_max","slope_exec_12m","reversiones_fin"]:
-    if c in snip.columns:
-        snip[c] = pd.to_numeric(snip[c], errors="coerce")
-
-for df in [muni, cod, ent]:
-    for c in ["presupuesto_vigente","ejecutado_total","no_ejecutado","ratio_ejec_agg",
-              "score_concentracion_baja_ejec","n_inconsistencia_estado_momento","presupuesto_inconsistencia_estado_momento"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
+# Schema fijo para columnas numéricas (filtros/orden/agregados).
+# Montos, ratios y scores quedan en float64: float32 cambia porcentajes mostrados
+# y el orden de los rankings. Solo conteos/flags van a enteros nullable pequeños.
+NUM_DTYPES = {
+    # snip
+    "presupuesto_actual_vigente": "float64",
+    "ejecutado_total_calc": "float64",
+    "no_ejecutado_vigente": "float64",
+    "slope_exec_12m": "float64",
+    "ratio_ejec_real": "float64",
+    "riesgo_fiscal": "float64",
+    "flag_inconsistencia_estado_momento": "Int8",
+    "months_since_last_exec": "Int16",
+    "zero_run_max": "Int16",
+    "reversiones_fin": "Int16",
+    # municipios / codede / entidades
+    "presupuesto_vigente": "float64",
+    "ejecutado_total": "float64",
+    "no_ejecutado": "float64",
+    "presupuesto_inconsistencia_estado_momento": "float64",
+    "ratio_ejec_agg": "float64",
+    "score_concentracion_baja_ejec": "float64",
+    "n_inconsistencia_estado_momento": "Int16",
+}
+CAT_COLS = ["departamento", "municipio", "entidad_ejecutora", "estado_auditoria"]
 
 # =========================
 # Formatting helpers
 # =========================
+NUMBER_TYPES = (int, float, np.number)
+
+def _is_num(x) -> bool:
+    # chequeo inline (sin try/except): números válidos, no NaN/None/pd.NA/strings
+    return isinstance(x, NUMBER_TYPES) and not np.isnan(x)
+
 def fmt_int(x):
-    if pd.isna(x): return "—"
-    try: return f"{int(round(float(x))):,}"
-    except: return "—"
+    if not _is_num(x) or not np.isfinite(x): return "—"
+    return f"{int(round(float(x))):,}"
 
 def fmt_float(x, decimals=2):
-    if pd.isna(x): return "—"
-    try: return f"{float(x):,.{decimals}f}"
-    except: return "—"
+    if not _is_num(x): return "—"
+    return f"{float(x):,.{decimals}f}"
 
 def fmt_money(x, decimals=2):
-    if pd.isna(x): return "—"
-    try: return f"Q {float(x):,.{decimals}f}"
-    except: return "—"
+    if not _is_num(x): return "—"
+    return f"Q {float(x):,.{decimals}f}"
 
 def fmt_pct(x, decimals=1):
-    if pd.isna(x): return "—"
-    try: return f"{100*float(x):,.{decimals}f}%"
-    except: return "—"
+    if not _is_num(x): return "—"
+    return f"{100*float(x):,.{decimals}f}%"
+
+def _fmt_col(s: pd.Series, fmt: str, scale: float = 1.0, as_int: bool = False) -> pd.Series:
+    # Versión por columna de fmt_*: máscara NaN vectorizada + un solo str.format por celda válida
+    v = pd.to_numeric(s, errors="coerce").astype("float64").to_numpy() * scale
+    ok = np.isfinite(v) if as_int else ~np.isnan(v)
+    out = np.full(len(v), "—", dtype=object)
+    vals = np.round(v[ok]).astype(np.int64) if as_int else v[ok]
+    out[ok] = list(map(fmt.format, vals.tolist()))
+    return pd.Series(out, index=s.index)
 
 def format_table(df: pd.DataFrame, money_cols=None, ratio_cols=None) -> pd.DataFrame:
     money_cols = set(money_cols or [])
     ratio_cols = set(ratio_cols or [])
-    out = df.copy()
+    # copia superficial: columnas sin formato comparten memoria con df; solo se crean las columnas de texto
+    out = df.copy(deep=False)
     for col in out.columns:
         if col == "snip":
             continue
         if col in money_cols:
-            out[col] = out[col].apply(fmt_money)
+            out[col] = _fmt_col(out[col], "Q {:,.2f}")
         elif col in ratio_cols:
-            out[col] = out[col].apply(fmt_pct)
+            out[col] = _fmt_col(out[col], "{:,.1f}%", scale=100)
         else:
             if pd.api.types.is_numeric_dtype(out[col]):
                 if pd.api.types.is_float_dtype(out[col]):
-                    out[col] = out[col].apply(fmt_float)
+                    out[col] = _fmt_col(out[col], "{:,.2f}")
                 else:
-                    out[col] = out[col].apply(fmt_int)
+                    out[col] = _fmt_col(out[col], "{:,}", as_int=True)
     return out
 
-
 SNIP_URL_TMPL = (
     "https://sistemas.segeplan.gob.gt/guest/"
     "SNPPKG$PL_PROYECTOS.INFORMACION?prmIdSnip={snip}"
@@ -111,13 +133,177 @@ def snip_link(snip):
     except:
         return "—"
     
+def snip_link_html(s: pd.Series) -> pd.Series:
+    # Versión vectorizada de snip_link (concatenación de Series, sin .apply por celda)
+    v = pd.to_numeric(s, errors="coerce").astype("float64")
+    ok = np.isfinite(v.to_numpy())
+    ids = v[ok].astype("int64").astype(str)
+    url_pre, url_post = SNIP_URL_TMPL.split("{snip}")
+    out = pd.Series("—", index=s.index, dtype=object)
+    out[ok] = '<a href="' + url_pre + ids + url_post + '" target="_blank">' + ids + "</a>"
+    return out
+
 def add_snip_link_column(df: pd.DataFrame) -> pd.DataFrame:
     out = df.copy()
     if "snip" in out.columns:
-        out["snip"] = out["snip"].apply(snip_link)
+        # precalculada en load_table; fallback vectorizado para frames derivados
+        out["snip"] = df["_snip_link_html"] if "_snip_link_html" in df.columns else snip_link_html(out["snip"])
         # out = out.drop(columns=["snip"])
     return out
 
+def popup_html(df: pd.DataFrame) -> pd.Series:
+    # HTML del popup por fila (concatenación vectorizada); se precalcula una vez en load_table
+    def col(c, default=""):
+        return df.get(c, pd.Series(default, index=df.index))
+
+    def txt(c):
+        v = col(c)
+        return v.astype(str).where(v.notna(), "")
+
+    return (
+        '<div style="font-size:12px; max-width:360px;">'
+        "<b>SNIP:</b> " + (df["_snip_link_html"] if "_snip_link_html" in df.columns
+                           else snip_link_html(col("snip", np.nan))) + "<br/>"
+        + "<b>Proyecto:</b> " + txt("nombre_de_proyecto").str.slice(0, 120) + "<br/>"
+        + "<b>Ubicación:</b> " + txt("departamento") + " / " + txt("municipio") + "<br/>"
+        + "<b>Estado auditoría:</b> " + txt("estado_auditoria") + "<br/>"
+        + "<b>Vigente:</b> " + _fmt_col(col("presupuesto_actual_vigente", np.nan), "Q {:,.2f}") + "<br/>"
+        + "<b>Ejecución:</b> " + _fmt_col(col("ratio_ejec_real", np.nan), "{:,.1f}%", scale=100) + "<br/>"
+        + "<b>Inconsistencia estado/momento:</b> " + np.where(col("_flag_inc", 0) == 1, "Sí", "No")
+        + "</div>"
+    )
+
+
+# =========================
+# Load
+# =========================
+@st.cache_resource
+def load_table(path: str) -> pd.DataFrame:
+    # cache_resource: un solo DataFrame compartido por todas las sesiones (sin copia por rerun).
+    # No mutar el resultado; derivar siempre nuevos frames.
+    # Cache en disco: Parquet junto al CSV (tipos nativos + columnas derivadas "_*");
+    # se regenera si el CSV o este script cambian.
+    pq_path = os.path.splitext(path)[0] + ".parquet"
+    src_mtime = max(os.path.getmtime(path), os.path.getmtime(__file__))
+    if os.path.exists(pq_path) and os.path.getmtime(pq_path) >= src_mtime:
+        # memory_map: pyarrow lee del archivo mapeado por el SO (sin buffer intermedio)
+        try:
+            return pd.read_parquet(pq_path, engine="pyarrow", memory_map=True)
+        except (OSError, pa.ArrowException):
+            pass  # cache corrupto/truncado: se reconstruye desde el CSV
+
+    df = pd.read_csv(path, dtype=NUM_DTYPES)
+    for c in ["latitud", "longitud"]:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").astype("float32")
+    for c in CAT_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    if {"latitud", "longitud"}.issubset(df.columns):
+        df["_has_coords"] = df["latitud"].notna() & df["longitud"].notna()
+    if "flag_inconsistencia_estado_momento" in df.columns:
+        df["_flag_inc"] = df["flag_inconsistencia_estado_momento"].fillna(0).astype("int8")
+    if "_has_coords" in df.columns:
+        # solo la tabla de proyectos (con coordenadas) muestra enlaces SNIP en el mapa
+        if "snip" in df.columns:
+            df["_snip_link_html"] = snip_link_html(df["snip"])
+        df["_popup_html"] = popup_html(df)
+    # escritura atómica: archivo temporal en el mismo directorio + os.replace,
+    # así un proceso interrumpido nunca deja un .parquet truncado en pq_path
+    tmp_path = f"{pq_path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp_path, pq_path)
+    except (OSError, pa.ArrowException):
+        # directorio de solo lectura o columna que pyarrow no serializa: seguimos con el CSV
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return df
+
+snip = load_table(SNIP_PATH)
+muni = load_table(MUN_PATH)
+cod  = load_table(COD_PATH)
+ent  = load_table(ENT_PATH)
+bud  = load_table(BUD_PATH)
+
+# Columnas de display (dependen solo del schema de snip)
+SNIP_TOP_COLS = [c for c in [
+    "snip","nombre_de_proyecto","departamento","municipio","entidad_ejecutora",
+    "estado_auditoria","momento_presupuestario","flag_inconsistencia_estado_momento",
+    "presupuesto_actual_vigente","ejecutado_total_calc","ratio_ejec_real","no_ejecutado_vigente",
+] if c in snip.columns]
+SNIP_DISPLAY_COLS = [c for c in [
+    "snip","nombre_de_proyecto","departamento","municipio","entidad_ejecutora",
+    "estado_auditoria","estado_reportado_ult","momento_presupuestario",
+    "presupuesto_actual_vigente","ejecutado_total_calc","ratio_ejec_real","no_ejecutado_vigente",
+    "months_since_last_exec","zero_run_max","slope_exec_12m","reversiones_fin",
+    "flag_inconsistencia_estado_momento"
+] if c in snip.columns]
+CAL_COLS = [c for c in [
+    "snip","nombre_de_proyecto","departamento","municipio","entidad_ejecutora","momento_presupuestario",
+    "presupuesto_actual_vigente","ratio_ejec_real"
+] if c in snip.columns]
+
+# =========================
+# Cached views (tablas ordenadas / formateadas)
+# =========================
+# Los frames de entrada vienen de load_table (cache_resource): su id es estable entre reruns.
+FRAME_ID = {pd.DataFrame: lambda d: (id(d), len(d))}
+
+@st.cache_resource(hash_funcs=FRAME_ID)
+def sorted_desc(df: pd.DataFrame, by) -> pd.DataFrame:
+    return df.sort_values(by, ascending=False)
+
+@st.cache_data(hash_funcs=FRAME_ID, max_entries=64)
+def build_disp(df: pd.DataFrame, cols=None, money_cols=None, ratio_cols=None) -> pd.DataFrame:
+    return format_table(df[cols] if cols else df, money_cols=money_cols, ratio_cols=ratio_cols)
+
+@st.cache_data(hash_funcs=FRAME_ID)
+def global_kpis(df_snip: pd.DataFrame):
+    # nansum sobre el array float64 contiguo (sin el camino skipna de pandas); una vez por dataset
+    tot_pres = float(np.nansum(df_snip["presupuesto_actual_vigente"].to_numpy(dtype="float64")))
+    tot_ejec = float(np.nansum(df_snip["ejecutado_total_calc"].to_numpy(dtype="float64")))
+    return int(df_snip["snip"].nunique()), tot_pres, tot_ejec
+
+def _by_estado(df_snip: pd.DataFrame) -> pd.DataFrame:
+    # Equivalente a groupby("estado_auditoria", dropna=False).agg(...) con np.bincount
+    # sobre los códigos de la categórica (NaN -> último grupo, como dropna=False).
+    est = df_snip["estado_auditoria"].astype("category")
+    n = len(est.cat.categories)
+    codes = est.cat.codes.to_numpy()
+    g = np.where(codes < 0, n, codes)
+
+    def gsum(col):
+        w = df_snip[col].to_numpy(dtype="float64", na_value=0.0)
+        return np.bincount(g, weights=w, minlength=n + 1)
+
+    # nunique de snip por grupo: pares (grupo, snip) únicos
+    snip_codes, snip_uniques = pd.factorize(df_snip["snip"])
+    valid = snip_codes >= 0
+    pairs = np.unique(g[valid].astype(np.int64) * len(snip_uniques) + snip_codes[valid])
+    proyectos = np.bincount(pairs // max(len(snip_uniques), 1), minlength=n + 1)
+
+    out = pd.DataFrame({
+        "estado_auditoria": pd.Categorical.from_codes(np.r_[np.arange(n), -1], dtype=est.dtype),
+        "proyectos": proyectos,
+        "presupuesto": gsum("presupuesto_actual_vigente"),
+        "ejecutado": gsum("ejecutado_total_calc"),
+        "no_ejecutado": gsum("no_ejecutado_vigente"),
+        "inconsistencias": gsum("flag_inconsistencia_estado_momento").astype(np.int64),
+    })
+    # solo grupos observados
+    return out[np.bincount(g, minlength=n + 1) > 0].reset_index(drop=True)
+
+@st.cache_resource(hash_funcs=FRAME_ID)
+def _overview_tables(df_snip: pd.DataFrame):
+    by_estado = _by_estado(df_snip)
+    by_estado["ratio_ejec"] = by_estado["ejecutado"] / by_estado["presupuesto"]
+
+    snip_sorted = df_snip.sort_values(["riesgo_fiscal","no_ejecutado_vigente"], ascending=False)
+    return by_estado, snip_sorted.head(30), snip_sorted.head(2000)
+
 
 
 # =========================
@@ -131,20 +317,28 @@ def ensure_state():
         st.session_state["map_filter"] = {"kind": "ALL"}  # default: all points
 
 def reset_map():
-    prev = st.session_state.get("map_filter", {"kind": "ALL"})
-    new = {"kind": "ALL"}
-    st.session_state["map_filter"] = new
-    # rerun solo si cambió (evita loops)
-    if prev != new:
-        st.rerun()
+    # el botón está antes del mapa en el script: basta con el rerun natural del botón
+    st.session_state["map_filter"] = {"kind": "ALL"}
 
 def set_map_filter(kind: str, payload: dict):
     prev = st.session_state.get("map_filter", {"kind": "ALL"})
     new = {"kind": kind, **payload}
     st.session_state["map_filter"] = new
-    # rerun solo si cambió (evita loops)
+    # Las tablas corren como fragmento y después del mapa: solo si el filtro cambió
+    # hace falta un rerun de toda la app para redibujar el mapa.
     if prev != new:
-        st.rerun()
+        st.rerun(scope="app")
+
+def selected_row(sel, source: str):
+    # Fila seleccionada en la tabla `source`, solo si cambió desde la última vez que se aplicó.
+    # Evita re-aplicar una selección que persiste (p.ej. después de Reset o de clic en otra tabla).
+    rows = sel.selection.rows if sel and sel.selection else []
+    r = rows[0] if rows else None
+    last = st.session_state.setdefault("_last_applied", {})
+    if last.get(source) == r:
+        return None
+    last[source] = r
+    return r
 
 ensure_state()
 
@@ -152,96 +346,101 @@ ensure_state()
 # =========================
 # Map filtering logic
 # =========================
-def filtered_points(df_snip: pd.DataFrame, mf: dict) -> pd.DataFrame:
-    d = df_snip.copy()
-
-    # only points with coords
-    if not {"latitud","longitud"}.issubset(d.columns):
-        return d.iloc[0:0]
+# Llaves del filtro del mapa por tipo (columnas de snip)
+FILTER_KEYS = {
+    "SNIP": ["snip"],
+    "MUNICIPIO": ["departamento", "municipio"],
+    "CODEDE": ["departamento"],
+    "ENTIDAD": ["entidad_ejecutora"],
+    "ESTADO": ["estado_auditoria"],
+}
+
+@st.cache_resource(hash_funcs=FRAME_ID)
+def point_index(df_snip: pd.DataFrame):
+    # Puntos con coordenadas + índice posicional por llave de filtro (lookup O(1) en vez de escanear strings)
+    if "_has_coords" not in df_snip.columns:
+        return df_snip.iloc[0:0], {}
+    pts = df_snip[df_snip["_has_coords"].to_numpy()]
+
+    idx = {}
+    for kind, keys in FILTER_KEYS.items():
+        if set(keys).issubset(pts.columns):
+            idx[kind] = pts.groupby(keys if len(keys) > 1 else keys[0], observed=True).indices
+    if "_flag_inc" in pts.columns:
+        idx["FLAG_INCONSISTENCIA"] = np.flatnonzero(pts["_flag_inc"].to_numpy() == 1)
+    return pts, idx
 
-    d["latitud"] = pd.to_numeric(d["latitud"], errors="coerce")
-    d["longitud"] = pd.to_numeric(d["longitud"], errors="coerce")
-    d = d.dropna(subset=["latitud","longitud"])
+def filtered_points(df_snip: pd.DataFrame, mf: dict) -> pd.DataFrame:
+    pts, idx = point_index(df_snip)
 
     kind = mf.get("kind", "ALL")
-
-    if kind == "ALL":
-        return d
-
-    if kind == "SNIP":
-        return d[d["snip"] == mf.get("snip")]
-
-    if kind == "MUNICIPIO":
-        return d[(d["departamento"] == mf.get("departamento")) & (d["municipio"] == mf.get("municipio"))]
-
-    if kind == "CODEDE":
-        return d[d["departamento"] == mf.get("departamento")]
-
-    if kind == "ENTIDAD":
-        return d[d["entidad_ejecutora"] == mf.get("entidad_ejecutora")]
-
-    if kind == "ESTADO":
-        return d[d["estado_auditoria"] == mf.get("estado_auditoria")]
-
-    if kind == "FLAG_INCONSISTENCIA":
-        return d[d["flag_inconsistencia_estado_momento"].fillna(0).astype(int) == 1]
-
-    return d
-
-def render_map(df_points: pd.DataFrame, title: str):
-    if df_points.empty:
-        st.info("No hay puntos para el filtro actual.")
-        return
-
-    center_lat = float(df_points["latitud"].median())
-    center_lon = float(df_points["longitud"].median())
-
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=7, tiles=None, control_scale=True)
+    if kind not in idx:
+        return pts
+
+    if kind in FILTER_KEYS:
+        key = tuple(mf.get(k) for k in FILTER_KEYS[kind])
+        rows = idx[kind].get(key if len(key) > 1 else key[0], [])
+    else:
+        rows = idx[kind]
+    return pts.take(rows)
+
+MARKER_CALLBACK = """function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 4, weight: 1, fill: true, fillOpacity: 0.85});
+    marker.bindPopup(row[2], {maxWidth: 450});
+    return marker;
+}"""
+
+def sample_points(df_points: pd.DataFrame) -> pd.DataFrame:
+    # Siempre los de mayor riesgo_fiscal + muestra aleatoria reproducible del resto (no el orden del CSV)
+    if len(df_points) <= MAX_MARKERS:
+        return df_points
+    if "riesgo_fiscal" not in df_points.columns:
+        return df_points.sample(n=MAX_MARKERS, random_state=0)
+    top_k = df_points.nlargest(TOP_RISK_MARKERS, "riesgo_fiscal")
+    rest = df_points.drop(top_k.index).sample(n=MAX_MARKERS - len(top_k), random_state=0)
+    return pd.concat([top_k, rest])
+
+@st.cache_data(max_entries=32)
+def build_map_html(points_key: tuple, _df_points: pd.DataFrame) -> str:
+    # points_key = (filtro, n puntos, suma de SNIP): detecta cambios sin hashear el frame
+    center_lat = float(_df_points["latitud"].median())
+    center_lon = float(_df_points["longitud"].median())
+
+    m = folium.Map(
+        location=[center_lat, center_lon], zoom_start=7, tiles=None, control_scale=True, min_zoom=MAP_MIN_ZOOM
+    )
     folium.TileLayer(
         tiles=ESRI_WORLD_IMAGERY,
         attr="Esri — World Imagery",
         name="Satélite",
         overlay=False,
-        control=True
+        control=True,
+        min_zoom=MAP_MIN_ZOOM
     ).add_to(m)
-    folium.TileLayer("OpenStreetMap", name="OSM", overlay=False, control=True).add_to(m)
+    folium.TileLayer("OpenStreetMap", name="OSM", overlay=False, control=True, min_zoom=MAP_MIN_ZOOM).add_to(m)
 
-    cluster = MarkerCluster(name="Proyectos").add_to(m)
+    pts = sample_points(_df_points)
 
-    # performance cap
-    max_markers = 5000
-    pts = df_points.head(max_markers)
-    
-
-    for _, r in pts.iterrows():
-        snip_val = r.get("snip", "")
-        snip_href = SNIP_URL_TMPL.format(snip=snip_val)
-        popup_html = f"""
-        <div style="font-size:12px; max-width:360px;">
-          <b>SNIP:</b>
-          <a href="{snip_href}" target="_blank">{snip_val}</a><br/>
-          <b>Proyecto:</b> {str(r.get("nombre_de_proyecto",""))[:120]}<br/>
-          <b>Ubicación:</b> {r.get("departamento","")} / {r.get("municipio","")}<br/>
-          <b>Estado auditoría:</b> {r.get("estado_auditoria","")}<br/>
-          <b>Vigente:</b> {fmt_money(r.get("presupuesto_actual_vigente", np.nan))}<br/>
-          <b>Ejecución:</b> {fmt_pct(r.get("ratio_ejec_real", np.nan))}<br/>
-          <b>Inconsistencia estado/momento:</b> {"Sí" if int(r.get("flag_inconsistencia_estado_momento",0) or 0)==1 else "No"}
-        </div>
-        """
-        folium.CircleMarker(
-            location=[float(r["latitud"]), float(r["longitud"])],
-            radius=4,
-            weight=1,
-            fill=True,
-            fill_opacity=0.85,
-            popup=folium.Popup(popup_html, max_width=450),
-        ).add_to(cluster)
+    # marcadores construidos en el navegador (JS), no un CircleMarker de Python por fila
+    data = list(zip(pts["latitud"].tolist(), pts["longitud"].tolist(), pts["_popup_html"].tolist()))
+    FastMarkerCluster(data, callback=MARKER_CALLBACK, name="Proyectos").add_to(m)
 
     folium.LayerControl(collapsed=True).add_to(m)
+    return m._repr_html_()
+
+def render_map(df_points: pd.DataFrame, title: str, mf: dict):
+    if df_points.empty:
+        st.info("No hay puntos para el filtro actual.")
+        return
+
+    points_key = (json.dumps(mf, sort_keys=True, default=str), len(df_points), int(df_points["snip"].sum()))
 
     st.subheader(title)
-    st.caption(f"Puntos: {len(df_points):,} (mostrando hasta {min(len(df_points), max_markers):,})")
-    st_html(m._repr_html_(), height=520)
+    if len(df_points) > MAX_MARKERS:
+        st.caption(f"Puntos: {len(df_points):,} (mostrando {MAX_MARKERS:,}: top {TOP_RISK_MARKERS:,} por riesgo fiscal + muestra aleatoria)")
+    else:
+        st.caption(f"Puntos: {len(df_points):,}")
+    st_html(build_map_html(points_key, df_points), height=520)
 
 # =========================
 # Header + KPI + Map
@@ -257,9 +456,7 @@ with cB:
     st.write(f"**Filtro actual del mapa:** `{mf}`")
 
 # KPIs globales
-total_snip = int(snip["snip"].nunique())
-tot_pres = float(snip["presupuesto_actual_vigente"].sum(skipna=True))
-tot_ejec = float(snip["ejecutado_total_calc"].sum(skipna=True))
+total_snip, tot_pres, tot_ejec = global_kpis(snip)
 ratio_global = (tot_ejec / tot_pres) if tot_pres else np.nan
 
 k1, k2, k3, k4 = st.columns(4)
@@ -268,152 +465,155 @@ k2.metric("Presupuesto vigente (suma)", fmt_money(tot_pres))
 k3.metric("Ejecutado estimado (suma)", fmt_money(tot_ejec))
 k4.metric("Ejecución global (ejec/vig)", fmt_pct(ratio_global))
 
-# Mapa arriba
-pts = filtered_points(snip, st.session_state["map_filter"])
-render_map(pts, "Mapa de proyectos (según selección en tablas)")
+# Mapa arriba (los reruns de fragmento de las pestañas no lo ejecutan; se redibuja
+# solo con el rerun completo que dispara set_map_filter)
+mf = st.session_state["map_filter"]
+pts = filtered_points(snip, mf)
+render_map(pts, "Mapa de proyectos (según selección en tablas)", mf)
 
 st.divider()
 
 # =========================
 # Tabs + clickable tables
 # =========================
+by_estado, top30, snip_top = _overview_tables(snip)
+
+# Cada pestaña es un fragmento: su selección re-ejecuta solo esa pestaña
+# (set_map_filter fuerza el rerun completo cuando el filtro del mapa cambia).
 tab_over, tab_snip, tab_mun, tab_cod, tab_ent, tab_cal = st.tabs(
     ["Panorama", "Explorador SNIP", "Municipios", "CODEDE", "Entidades", "Calidad/Consistencia"]
 )
 
 # -------- Panorama (tablas que también controlan el mapa) --------
-with tab_over:
+@st.fragment
+def panorama_tab():
     st.subheader("Estado auditoría: conteos y dinero (clic para filtrar mapa por estado)")
-    by_estado = snip.groupby("estado_auditoria", dropna=False).agg(
-        proyectos=("snip","nunique"),
-        presupuesto=("presupuesto_actual_vigente","sum"),
-        ejecutado=("ejecutado_total_calc","sum"),
-        no_ejecutado=("no_ejecutado_vigente","sum"),
-        inconsistencias=("flag_inconsistencia_estado_momento","sum"),
-    ).reset_index()
-    by_estado["ratio_ejec"] = by_estado["ejecutado"] / by_estado["presupuesto"]
-
     # selección
-    disp = format_table(by_estado, money_cols=["presupuesto","ejecutado","no_ejecutado"], ratio_cols=["ratio_ejec"])
+    disp = build_disp(by_estado, money_cols=["presupuesto","ejecutado","no_ejecutado"], ratio_cols=["ratio_ejec"])
     sel = st.dataframe(
         disp, use_container_width=True, hide_index=True,
         on_select="rerun", selection_mode="single-row"
     )
-    if sel and sel.selection and sel.selection.rows:
-        r = sel.selection.rows[0]
-        estado_sel = by_estado.iloc[r]["estado_auditoria"]
+    r = selected_row(sel, "estado")
+    if r is not None:
+        estado_sel = by_estado["estado_auditoria"].to_numpy()[r]
         set_map_filter("ESTADO", {"estado_auditoria": estado_sel})
 
     st.subheader("Top 30 SNIP por riesgo fiscal (clic para filtrar mapa a ese SNIP)")
-    top = snip.sort_values(["riesgo_fiscal","no_ejecutado_vigente"], ascending=False).head(30)
-    cols = [
-        "snip","nombre_de_proyecto","departamento","municipio","entidad_ejecutora",
-        "estado_auditoria","momento_presupuestario","flag_inconsistencia_estado_momento",
-        "presupuesto_actual_vigente","ejecutado_total_calc","ratio_ejec_real","no_ejecutado_vigente",
-    ]
-    cols = [c for c in cols if c in top.columns]
-    disp2 = format_table(top[cols], money_cols=MONEY_COLS_SNIP, ratio_cols=RATIO_COLS_SNIP)
+    disp2 = build_disp(top30, SNIP_TOP_COLS, money_cols=MONEY_COLS_SNIP, ratio_cols=RATIO_COLS_SNIP)
 
     sel2 = st.dataframe(
         disp2, use_container_width=True, hide_index=True,
         on_select="rerun", selection_mode="single-row"
     )
-    if sel2 and sel2.selection and sel2.selection.rows:
-        r = sel2.selection.rows[0]
-        snip_sel = int(top.iloc[r]["snip"])
+    r = selected_row(sel2, "top30")
+    if r is not None:
+        snip_sel = int(top30["snip"].to_numpy()[r])
         set_map_filter("SNIP", {"snip": snip_sel})
 
+with tab_over:
+    panorama_tab()
+
 # -------- Explorador SNIP (tabla completa, clic SNIP) --------
-with tab_snip:
+@st.fragment
+def snip_tab():
     st.subheader("Explorador SNIP (clic en fila para filtrar mapa)")
     st.caption("Tip: ordena por 'riesgo_fiscal' o 'no_ejecutado_vigente' si quieres priorizar.")
 
-    df = snip.copy().sort_values(["riesgo_fiscal","no_ejecutado_vigente"], ascending=False)
-    cols = [
-        "snip","nombre_de_proyecto","departamento","municipio","entidad_ejecutora",
-        "estado_auditoria","estado_reportado_ult","momento_presupuestario",
-        "presupuesto_actual_vigente","ejecutado_total_calc","ratio_ejec_real","no_ejecutado_vigente",
-        "months_since_last_exec","zero_run_max","slope_exec_12m","reversiones_fin",
-        "flag_inconsistencia_estado_momento"
-    ]
-    cols = [c for c in cols if c in df.columns]
-    disp = format_table(df[cols].head(2000), money_cols=MONEY_COLS_SNIP, ratio_cols=RATIO_COLS_SNIP)
+    disp = build_disp(snip_top, SNIP_DISPLAY_COLS, money_cols=MONEY_COLS_SNIP, ratio_cols=RATIO_COLS_SNIP)
 
     sel = st.dataframe(
         disp, use_container_width=True, hide_index=True,
         on_select="rerun", selection_mode="single-row"
     )
-    if sel and sel.selection and sel.selection.rows:
-        r = sel.selection.rows[0]
-        snip_sel = int(df.iloc[r]["snip"])
+    r = selected_row(sel, "snip")
+    if r is not None:
+        snip_sel = int(snip_top["snip"].to_numpy()[r])
         set_map_filter("SNIP", {"snip": snip_sel})
 
+with tab_snip:
+    snip_tab()
+
 # -------- Municipios (clic -> municipio) --------
-with tab_mun:
+@st.fragment
+def municipios_tab():
     st.subheader("Municipios: concentración de baja ejecución (clic en fila para ver puntos del municipio)")
-    topm = muni.sort_values("score_concentracion_baja_ejec", ascending=False)
+    topm = sorted_desc(muni, "score_concentracion_baja_ejec")
 
     # Asegurar columnas de llave
     key_cols = [c for c in ["departamento","municipio"] if c in topm.columns]
-    disp = format_table(topm, money_cols=MONEY_COLS_AGG, ratio_cols=RATIO_COLS_AGG)
+    disp = build_disp(topm, money_cols=MONEY_COLS_AGG, ratio_cols=RATIO_COLS_AGG)
 
     sel = st.dataframe(
         disp, use_container_width=True, hide_index=True,
         on_select="rerun", selection_mode="single-row"
     )
-    if sel and sel.selection and sel.selection.rows:
-        r = sel.selection.rows[0]
-        dep = topm.iloc[r]["departamento"]
-        mu  = topm.iloc[r]["municipio"]
+    r = selected_row(sel, "municipios")
+    if r is not None:
+        dep = topm["departamento"].to_numpy()[r]
+        mu  = topm["municipio"].to_numpy()[r]
         set_map_filter("MUNICIPIO", {"departamento": dep, "municipio": mu})
 
+with tab_mun:
+    municipios_tab()
+
 # -------- CODEDE (clic -> depto) --------
-with tab_cod:
+@st.fragment
+def codede_tab():
     st.subheader("CODEDE (Departamento): concentración de baja ejecución (clic en fila para ver puntos del departamento)")
-    topc = cod.sort_values("score_concentracion_baja_ejec", ascending=False)
+    topc = sorted_desc(cod, "score_concentracion_baja_ejec")
 
-    disp = format_table(topc, money_cols=MONEY_COLS_AGG, ratio_cols=RATIO_COLS_AGG)
+    disp = build_disp(topc, money_cols=MONEY_COLS_AGG, ratio_cols=RATIO_COLS_AGG)
     sel = st.dataframe(
         disp, use_container_width=True, hide_index=True,
         on_select="rerun", selection_mode="single-row"
     )
-    if sel and sel.selection and sel.selection.rows:
-        r = sel.selection.rows[0]
-        dep = topc.iloc[r]["departamento"]
+    r = selected_row(sel, "codede")
+    if r is not None:
+        dep = topc["departamento"].to_numpy()[r]
         set_map_filter("CODEDE", {"departamento": dep})
 
+with tab_cod:
+    codede_tab()
+
 # -------- Entidades (clic -> entidad) --------
-with tab_ent:
+@st.fragment
+def entidades_tab():
     st.subheader("Entidades ejecutoras: concentración de baja ejecución (clic en fila para ver puntos de la entidad)")
-    tope = ent.sort_values("score_concentracion_baja_ejec", ascending=False)
+    tope = sorted_desc(ent, "score_concentracion_baja_ejec")
 
-    disp = format_table(tope, money_cols=MONEY_COLS_AGG, ratio_cols=RATIO_COLS_AGG)
+    disp = build_disp(tope, money_cols=MONEY_COLS_AGG, ratio_cols=RATIO_COLS_AGG)
     sel = st.dataframe(
         disp, use_container_width=True, hide_index=True,
         on_select="rerun", selection_mode="single-row"
     )
-    if sel and sel.selection and sel.selection.rows:
-        r = sel.selection.rows[0]
-        ee = tope.iloc[r]["entidad_ejecutora"]
+    r = selected_row(sel, "entidades")
+    if r is not None:
+        ee = tope["entidad_ejecutora"].to_numpy()[r]
         set_map_filter("ENTIDAD", {"entidad_ejecutora": ee})
 
+with tab_ent:
+    entidades_tab()
+
 # -------- Calidad / Consistencia (clic -> inconsistencias) --------
-with tab_cal:
+@st.fragment
+def calidad_tab():
     st.subheader("Inconsistencia: Finalizado (auditoría) vs Momento presupuestario activo (clic para mapear solo esos puntos)")
     if "flag_inconsistencia_estado_momento" in snip.columns:
-        n_inc = int(snip["flag_inconsistencia_estado_momento"].fillna(0).sum())
-        q_inc = float(snip.loc[snip["flag_inconsistencia_estado_momento"] == 1, "presupuesto_actual_vigente"].sum())
+        flag = snip["_flag_inc"] == 1
+        n_inc = int(flag.sum())
+        q_inc = float(snip.loc[flag, "presupuesto_actual_vigente"].sum())
         c1, c2, c3 = st.columns(3)
         c1.metric("Proyectos con inconsistencia", f"{n_inc:,}")
         c2.metric("Presupuesto asociado (vigente)", fmt_money(q_inc))
         if c3.button("Ver estos puntos en el mapa"):
             set_map_filter("FLAG_INCONSISTENCIA", {})
 
-        sample = snip.loc[snip["flag_inconsistencia_estado_momento"] == 1].sort_values("presupuesto_actual_vigente", ascending=False).head(50)
-        cols = ["snip","nombre_de_proyecto","departamento","municipio","entidad_ejecutora","momento_presupuestario",
-                "presupuesto_actual_vigente","ratio_ejec_real"]
-        cols = [c for c in cols if c in sample.columns]
+        sample = snip.loc[flag].sort_values("presupuesto_actual_vigente", ascending=False).head(50)
         st.dataframe(
-            format_table(sample[cols], money_cols=["presupuesto_actual_vigente"], ratio_cols=["ratio_ejec_real"]),
+            format_table(sample[CAL_COLS], money_cols=["presupuesto_actual_vigente"], ratio_cols=["ratio_ejec_real"]),
             use_container_width=True, hide_index=True
         )
+
+with tab_cal:
+    calidad_tab()